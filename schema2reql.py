@@ -1,10 +1,20 @@
 import rethinkdb as r
+import hashlib
 import json
+import re
 import sys
-from functools import wraps
+from functools import lru_cache, partial
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 META_KEYWORDS = {'title', 'description', 'default'}
+# Keywords that don't check anything themselves, they're only read by
+# the handlers of their sibling keywords
+FLAG_KEYWORDS = {'exclusiveMaximum', 'exclusiveMinimum', 'patternProperties'}
 VERBOSE = False
 
 schema_to_reql_type = {
@@ -17,140 +27,357 @@ schema_to_reql_type = {
     'string': 'STRING',
 }
 
+# Fragments asserting each schema type, so type checks don't need to
+# look anything up while a schema is being compiled. Each is a list of
+# fragments to be and-ed together
+type_checks = {
+    t: ['v.type_of() == %r' % (reql_type,)]
+    for t, reql_type in schema_to_reql_type.items()
+}
+# Add additional check for integers
+type_checks['integer'].append('v.floor() == v')
+
+# The instance types each schema type guarantees. Integers are numbers
+# too, so number keywords apply to them
+implied_types = {t: {t} for t in schema_to_reql_type}
+implied_types['integer'].add('number')
+
 
 def main(filename):
-    with open(filename) as f:
-        schema = json.load(f)
-    print(str(r.expr(validate(schema, path='#').to_reql())))
+    print(str(validate(load_schema(filename), path='#')))
 
 
-def validate(schema, path='#'):
-    '''Main validation function'''
-    return Validator(schema, path).to_reql()
+def load_schema(filename):
+    '''Reads a schema file, using orjson if it's installed'''
+    if orjson is not None:
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(filename) as f:
+        return json.load(f)
+
+
+def validate(schema, path='#', verbose=False):
+    '''Main validation function, returns a reql function'''
+    # Paths only show up in verbose errors, so they aren't part of the
+    # key otherwise
+    return _term(Schema(schema), path if verbose else None, verbose=verbose)
+
+
+class Schema:
+    '''A schema paired with the digest of its canonical form
+
+    Schemas hash and compare by digest alone, so they can be cache keys
+    while still carrying the schema to compile on a miss. digests maps
+    the id of every dict and list in the outermost schema they were
+    computed for to its digest, so nested schemas reuse them instead of
+    being digested again.
+    '''
+
+    __slots__ = ('value', 'digests', 'digest')
+
+    def __init__(self, value, digests=None):
+        if digests is None:
+            digests = {}
+            _digest(value, digests)
+        self.value = value
+        self.digests = digests
+        self.digest = digests[id(value)]
+
+    def nested(self, value):
+        '''Returns the Schema for a schema nested inside this one'''
+        return Schema(value, self.digests)
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __eq__(self, other):
+        return isinstance(other, Schema) and self.digest == other.digest
+
+
+def _digest(value, digests):
+    '''Returns the digest of a json value's canonical form
+
+    Digests are computed bottom up, and a child's digest stands in for
+    it in its parent's, so each part of a schema is serialized once
+    however deeply it's nested. The digest of every dict and list is
+    recorded in digests by id.
+    '''
+    if isinstance(value, dict):
+        shape = ['{'] + sorted(
+            [key, _digest(v, digests)] for key, v in value.items())
+    elif isinstance(value, list):
+        shape = ['['] + [_digest(v, digests) for v in value]
+    else:
+        return json.dumps(value)
+    digest = hashlib.sha1(json.dumps(shape).encode('utf-8')).hexdigest()
+    digests[id(value)] = digest
+    return digest
+
+
+def codegen(schema, verbose=False):
+    '''Generates the source of a module that builds a schema's query
+
+    The module defines _f(v, path), which returns the query for the
+    value v as one expression, with no dispatch on keywords left in it.
+    Nested schemas are looked up in _nested, the list of Schemas the
+    module is run with.
+    '''
+    return Validator(Schema(schema), verbose).codegen()
+
+
+@lru_cache(maxsize=512)
+def _build(schema, verbose):
+    '''Compiles a Schema into a function of (value, path)'''
+    validator = Validator(schema, verbose)
+    source = validator.codegen()
+    env = {
+        'r': r, 'partial': partial, '_term': _term,
+        '_nested': validator.nested,
+    }
+    filename = '<schema:%s>' % (schema.value.get('title', ''),)
+    exec(compile(source, filename, 'exec'), env)
+    return env['_f']
+
+
+@lru_cache(maxsize=512)
+def _term(schema, path, verbose):
+    '''Builds the reql function for a Schema at a path'''
+    # Keyword only defaults so reql sees a function of one argument
+    return r.expr(lambda v, *, check=_build(schema, verbose), path=path:
+                  check(v, path))
+
+
+def literal_pattern(pattern):
+    '''Returns the only string a pattern can match, or None'''
+    if pattern.startswith('^') and pattern.endswith('$'):
+        literal = pattern[1:-1]
+        if re.escape(literal) == literal:
+            return literal
+    return None
 
 
 def propfor(prop_type):
+    '''Marks a keyword method as only applying to values of prop_type'''
     def _propfor(f):
-        @wraps(f)
-        def checker(self, arg):
-            check = f(self, arg)
-            if self.schema.get('type') is None:
-                # No type assertion, so emit conditionally with other
-                # soft checks dependent on a type
-                self.ctx.soft_checks.setdefault(prop_type, []).append(
-                    self.ctx.build_check(check))
-                return None, None
-            elif self.schema.get('type') == prop_type:
-                # A type assertion for this type exists, so just emit
-                # this check as a normal conjunction
-                return check
-            else:
-                # A type assertion for another type exists, don't emit
-                # anything, we can't possibly succeed
-                return None, None
-        return checker
+        f.prop_type = prop_type
+        return f
     return _propfor
 
 
+class ValidatorMeta(type):
+    '''Builds the keyword tables of a validator class once, when defined
+
+    prop_types maps each keyword marked with propfor to its type, and
+    skip_keywords maps each schema type to the keywords that don't apply
+    to it, so validators never compare types per keyword.
+    '''
+
+    def __new__(mcs, name, bases, namespace):
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls.prop_types = {
+            keyword: handler.prop_type
+            for keyword, handler in cls.handlers.items()
+            if hasattr(handler, 'prop_type')
+        }
+        cls.skip_keywords = {
+            schema_type: frozenset(
+                keyword for keyword, prop_type in cls.prop_types.items()
+                if prop_type not in implied)
+            for schema_type, implied in implied_types.items()
+        }
+        return cls
+
+
 def conjunct(checks):
-    '''Turns an array of check functions into a single conjunction'''
+    '''Turns an array of check fragments into a single conjunction'''
+    if len(checks) == 0:
+        return 'True'
+    if len(checks) == 1:
+        return checks[0]
+    return 'r.and_(%s)' % ', '.join(checks)
+
+
+def disjunct(checks):
+    '''Turns an array of check fragments into a single disjunction'''
     if len(checks) == 0:
-        return lambda v: True
+        return 'False'
     if len(checks) == 1:
         return checks[0]
-    return lambda v: r.and_(*list(map(lambda check: check(v), checks)))
+    return 'r.or_(%s)' % ', '.join(checks)
+
+
+class CodeGen:
+    '''Accumulates the source of a module defining a validation function'''
+
+    __slots__ = ('lines', 'bound')
+
+    def __init__(self):
+        self.lines = []
+        self.bound = []
+
+    def bind(self, expr):
+        '''Evaluates expr once when the module runs, returns its name
+
+        Use this for anything that can be built once up front, like reql
+        terms for literals and compiled subschemas.
+        '''
+        name = '_c%d' % (len(self.bound),)
+        self.bound.append(name)
+        self.lines.append('%s = %s' % (name, expr))
+        return name
+
+    def module(self, expr):
+        '''Returns the module source, with expr as the function's body
+
+        Bound values are passed in as keyword only defaults, so the
+        function reads them as locals rather than globals.
+        '''
+        defaults = ''.join([', %s=%s' % (name, name) for name in self.bound])
+        return '\n'.join(self.lines + [
+            'def _f(v, path, *, r=r%s):' % (defaults,),
+            '    return %s' % (expr,),
+            '',
+        ])
 
 
 class Context:
+    __slots__ = ('verbose', 'soft_checks', 'conjunction')
+
     def __init__(self, verbose):
         self.verbose = verbose
         self.soft_checks = {}
         self.conjunction = []
 
     def to_reql(self):
-        '''Convert this context to a reql function'''
+        '''Convert this context to a reql fragment'''
         # Emit soft checks, bunching together all checks that are
-        # conditional on a particular type being asserted
-        for soft_type, checks in self.soft_checks.items():
-            self.conjunction.append(lambda v: r.branch(
-                v.type_of() == schema_to_reql_type[soft_type],
-                conjunct(checks)(v),
-                True  # if type doesn't match, it's ok
-            ))
-        return conjunct(self.conjunction)
+        # conditional on a particular type being asserted. If the type
+        # doesn't match, it's ok
+        soft_branches = [
+            'r.branch(%s, %s, True)' % (
+                conjunct(type_checks[soft_type]), conjunct(checks))
+            for soft_type, checks in self.soft_checks.items()
+        ]
+        return conjunct(self.conjunction + soft_branches)
 
     def also(self, check):
         '''Adds a requirement to the running tests for this schema'''
         if check[0] is not None:
-            self.conjunction.append(self.build_check(check))
+            self.conjunction.extend(self.build_checks(check))
+
+    def also_if(self, prop_type, check):
+        '''Adds a requirement that only applies to values of prop_type'''
+        if check[0] is not None:
+            self.soft_checks.setdefault(prop_type, []).extend(
+                self.build_checks(check))
 
-    def build_check(self, check):
+    def build_checks(self, check):
+        '''Flattens a check into the fragments it adds to a conjunction
+
+        A check's test is either a single fragment or a list of fragments
+        that must all hold. Lists are spliced into the surrounding
+        conjunction so no nested r.and_ gets emitted for them.
+        '''
         test, error_msg = check
+        tests = test if isinstance(test, list) else [test]
         if self.verbose:
             # TODO: check if we're reverse logic to decide whether to
             # demorgan this branch
-            return self.to_branch(test, error_msg)
+            return [self.to_branch(conjunct(tests), error_msg)]
         else:
-            return test
+            return tests
 
     def to_branch(self, test, error_msg):
         '''Turns a normal test into an ugly but helpful branch/error test'''
-        return lambda v: r.branch(
-            test(v),
-            True,
-            r.error(self.path + ' ' + error_msg),
-        )
-
-
-class Validator:
-    def __init__(self, schema, path='#', verbose=False):
-        self.schema = schema
-        self.path = path
+        return 'r.branch(%s, True, r.error(path + %r))' % (
+            test, ' ' + error_msg)
+
+
+class Validator(metaclass=ValidatorMeta):
+    __slots__ = (
+        'key', 'schema', 'schema_type', 'skipped', 'asserted', 'ctx', 'gen',
+        'nested', 'verbose',
+    )
+
+    def __init__(self, key, verbose=False):
+        self.key = key
+        self.schema = key.value
+        self.schema_type = self.schema.get('type')
+        # Keywords for types none of the asserted types allow can't fail
+        # so they're skipped. Keywords for a type every asserted type
+        # implies are emitted as normal checks. The rest are emitted as
+        # soft checks, conditional on the value having their type
+        if isinstance(self.schema_type, list):
+            types = self.schema_type
+        elif self.schema_type is not None:
+            types = [self.schema_type]
+        else:
+            types = []
+        if types:
+            self.skipped = frozenset.intersection(
+                *[self.skip_keywords[t] for t in types])
+            self.asserted = set.intersection(
+                *[implied_types[t] for t in types])
+        else:
+            self.skipped = frozenset()
+            self.asserted = set()
         self.ctx = None
+        self.gen = None
+        self.nested = None
         self.verbose = verbose
 
-    def to_reql(self):
+    def codegen(self):
         self.ctx = Context(self.verbose)
-        if 'type' in self.schema:
-            self.ctx.also(self.type(self.schema['type']))
+        self.gen = CodeGen()
+        self.nested = []
+        if self.schema_type is not None:
+            self.ctx.also(self.type(self.schema_type))
         for keyword, spec in self.schema.items():
-            if keyword in ('type', 'description', 'title'):
-                continue  # already handled
-            if keyword == 'not':
-                keyword = 'not_'  # python keyword collision!
-            try:
-                self.ctx.also(getattr(self, keyword)(self.schema[keyword]))
-            except AttributeError as ae:
+            if keyword in self.ignored or keyword in self.skipped:
+                continue
+            if keyword not in self.handlers:
                 raise NotImplementedError(keyword)
-        return self.ctx.to_reql()
-
-    def default(self, arg):
-        '''No-op'''
-        return None, None
-
-    def type(self, arg):
-        def type_check(v):
-            def type_to_reql(t):
-                check = v.type_of() == schema_to_reql_type[t]
-                if t == 'integer':
-                    # Add additional check for integers
-                    check = check & (v.floor() == v)
-                return check
-
-            if isinstance(arg, list):
-                check = r.or_(*map(type_to_reql, arg))
+            handler = self.handlers[keyword]
+            prop_type = self.prop_types.get(keyword)
+            if prop_type is None or prop_type in self.asserted:
+                self.ctx.also(handler(self, spec))
             else:
-                check = type_to_reql(arg)
-            return check
+                self.ctx.also_if(prop_type, handler(self, spec))
+        return self.gen.module(self.ctx.to_reql())
+
+    def subschema(self, schema, suffix=''):
+        '''Binds a nested schema, returns code for its reql function
+
+        The nested schema's function is built once per path, so nested
+        schemas aren't rebuilt each time the query containing them is.
+        suffix is appended to this schema's path to give the nested
+        one's. Outside verbose mode paths are never reported, so the path
+        is None and every use of a nested schema shares one function.
+        '''
+        self.nested.append(self.key.nested(schema))
+        name = self.gen.bind('partial(_term, _nested[%d], verbose=%r)' % (
+            len(self.nested) - 1, self.verbose))
+        if not self.verbose:
+            return '%s(None)' % (name,)
+        elif suffix:
+            return '%s(path + %r)' % (name, suffix)
+        else:
+            return '%s(path)' % (name,)
 
-        return (type_check, 'type must be %s' % (arg,))
+    def type(self, arg):
+        if isinstance(arg, list):
+            check = disjunct([conjunct(type_checks[t]) for t in arg])
+        else:
+            check = type_checks[arg]
+        return (check, 'type must be %s' % (arg,))
 
     # keywords for any instance type
 
     def enum(self, arg):
         return (
-            lambda v: r.expr(arg).contains(v),
-            'must be equal to one of [%s]' % (', '.join(map(repr, arg))),
+            '%s.contains(v)' % (self.gen.bind('r.expr(%r)' % (arg,)),),
+            'must be equal to one of [%s]' % (
+                ', '.join([repr(value) for value in arg]),),
         )
 
     # def allOf(self, arg):
@@ -169,21 +396,21 @@ class Validator:
     @propfor('string')
     def maxLength(self, arg):
         return (
-            lambda v: v.count() <= arg,
+            'v.count() <= %r' % (arg,),
             'must have length at most %s' % (arg,),
         )
 
     @propfor('string')
     def minLength(self, arg):
         return (
-            lambda v: v.count() >= arg,
+            'v.count() >= %r' % (arg,),
             'must have length at least %s' % (arg,),
         )
 
     @propfor('string')
     def pattern(self, arg):
         return (
-            lambda v: v.match(arg) != None,
+            'v.match(%r) != None' % (arg,),
             'must match the regex "%s"' % (arg,),
         )
 
@@ -193,7 +420,7 @@ class Validator:
         # floats too apparently. So we check if dividing results in a
         # whole number instead
         return (
-            lambda v: r.do(v.div(arg), lambda r: r.floor() == r),
+            'r.do(v.div(%r), lambda q: q.floor() == q)' % (arg,),
             'must be a multiple of %s' % (arg,),
         )
 
@@ -201,12 +428,12 @@ class Validator:
     def maximum(self, arg):
         if self.schema.get('exclusiveMaximum') is True:
             return (
-                lambda v: v < arg,
+                'v < %r' % (arg,),
                 'must be less than %s' % (arg,),
             )
         else:
             return (
-                lambda v: v <= arg,
+                'v <= %r' % (arg,),
                 'must be at most than %s' % (arg,),
             )
 
@@ -214,57 +441,46 @@ class Validator:
     def minimum(self, arg):
         if self.schema.get('exclusiveMinimum') is True:
             return (
-                lambda v: v > arg,
+                'v > %r' % (arg,),
                 'must be greater than %s' % (arg,),
             )
         else:
             return (
-                lambda v: v >= arg,
+                'v >= %r' % (arg,),
                 'must be at least %s' % (arg,),
             )
 
-    def exclusiveMaximum(self, arg):
-        'A flag for maximum'
-        return None, None  # no-op
-
-    def exclusiveMinimum(self, arg):
-        'A flag for minimum'
-        return None, None  # no-op
-
     @propfor('object')
     def maxProperties(self, arg):
         return (
-            lambda obj: obj.count() <= arg,
+            'v.count() <= %r' % (arg,),
             'must not have more than %s properties' % (arg,),
         )
 
     @propfor('object')
     def minProperties(self, arg):
         return (
-            lambda obj: obj.count() >= arg,
+            'v.count() >= %r' % (arg,),
             'must have at least %s properties' % (arg,),
         )
 
     @propfor('object')
     def required(self, arg):
         return (
-            lambda v: v.has_fields(arg),
+            'v.has_fields(%s)' % (self.gen.bind('r.expr(%r)' % (arg,)),),
             'must have the required fields: %s' % (','.join(arg),),
         )
 
     @propfor('object')
     def properties(self, arg):
-        def prop_check(v):
-            props = []
-            for prop, prop_schema in arg.items():
-                sub_path = self.path + '/' + prop
-                props.append(r.branch(
-                    v.has_fields(prop),
-                    r.do(v[prop], validate(prop_schema, sub_path)),
-                    True,
-                ))
-            return r.and_(*props)
-        return prop_check, 'properties must all validate'
+        # One branch per property, each joins the schema's conjunction
+        props = [
+            'r.branch(v.has_fields(%r), '
+            'r.do(v[%r], %s), True)' % (
+                prop, prop, self.subschema(prop_schema, '/' + prop))
+            for prop, prop_schema in arg.items()
+        ]
+        return props, 'properties must all validate'
 
     @propfor('object')
     def additionalProperties(self, arg):
@@ -273,20 +489,25 @@ class Validator:
         addntl = self.schema.get('additionalProperties')
         if addntl is True or addntl == {}:
             return None, None
-        def validator(v):
-            props = v.keys()
-            if properties:
-                props = props.set_difference(properties.keys())
-            if pattern_props:
-                pats = pattern_props.keys()
-                super_pattern = '(?:' + ')|(?:'.join(pats) + ')'
-                props = props.filter(
-                    lambda x: x.match(super_pattern) == None)
-            return props.is_empty()
-        return (validator, 'additional properties must validate')
-
-    def patternProperties(self, arg):
-        return None, None
+        # Patterns that only match one name are checked like properties,
+        # the rest get combined into one regex
+        known = list(properties.keys())
+        pats = []
+        for pat in pattern_props:
+            literal = literal_pattern(pat)
+            if literal is None:
+                pats.append(pat)
+            else:
+                known.append(literal)
+        props = 'v.keys()'
+        if known:
+            props += '.set_difference(%s)' % (
+                self.gen.bind('r.expr(%r)' % (known,)),)
+        if pats:
+            super_pattern = '(?:' + ')|(?:'.join(pats) + ')'
+            props += '.filter(lambda x: x.match(%r) == None)' % (
+                super_pattern,)
+        return (props + '.is_empty()', 'additional properties must validate')
 
     # @propfor('object')
     # def dependencies(self, arg):
@@ -295,14 +516,14 @@ class Validator:
     @propfor('array')
     def items(self, arg):
         'This should really be implemented...'
-        items = self.schema.get('items')
-        def check(v):
-            if isinstance(items, dict):
-                print('going to validate', items)
-                return v.filter(lambda x: ~validate(items)(x)).is_empty()
-            elif isinstance(items, list):
-                return r.and_(*[r.do(v.nth(i), validator)
-                          for i, validator in enumerate(map(validate, items))])
+        if isinstance(arg, dict):
+            check = 'v.map(%s).contains(False).not_()' % (
+                self.subschema(arg),)
+        elif isinstance(arg, list):
+            check = [
+                'r.do(v.nth(%d), %s)' % (i, self.subschema(item, '/%d' % i))
+                for i, item in enumerate(arg)
+            ]
         return check, 'items in array must validate'
 
     # @propfor('array')
@@ -312,14 +533,14 @@ class Validator:
     @propfor('array')
     def maxItems(self, arg):
         return (
-            lambda v: v.count() <= arg,
+            'v.count() <= %r' % (arg,),
             'must have at most %s items' % (arg,),
         )
 
     @propfor('array')
     def minItems(self, arg):
         return (
-            lambda v: v.count() >= arg,
+            'v.count() >= %r' % (arg,),
             'must have at least %s items' % (arg,),
         )
 
@@ -330,12 +551,30 @@ class Validator:
     def ref(self, arg):
         return None, None
 
-    def __getattr__(self, name):
-        if name == '$ref':
-            return self.ref
-        else:
-            raise NotImplementedError(name)
-
+    # Keywords to pass over without dispatching. The type keyword is
+    # handled first, before the others
+    ignored = frozenset(META_KEYWORDS | FLAG_KEYWORDS | {'type'})
+
+    # Maps each keyword to the method implementing it. Keywords missing
+    # from here and from ignored are unimplemented
+    handlers = {
+        'enum': enum,
+        'maxLength': maxLength,
+        'minLength': minLength,
+        'pattern': pattern,
+        'multipleOf': multipleOf,
+        'maximum': maximum,
+        'minimum': minimum,
+        'maxProperties': maxProperties,
+        'minProperties': minProperties,
+        'required': required,
+        'properties': properties,
+        'additionalProperties': additionalProperties,
+        'items': items,
+        'maxItems': maxItems,
+        'minItems': minItems,
+        '$ref': ref,
+    }
 
 
 if __name__ == '__main__':
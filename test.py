@@ -31,7 +31,7 @@ def main(match, print_success):
         for td in test_definitions:
             click.secho(' ' + td['description'], bold=True, fg='yellow')
             try:
-                schema_filter = r.expr(validate(td['schema']))
+                schema_filter = validate(td['schema'])
             except NotImplementedError as nie:
                 num_failed = len(td['tests'])
                 click.secho('  schema had unimplemented keyword "%s" '
@@ -40,13 +40,8 @@ def main(match, print_success):
                             fg='red', bold=True)
                 results[name]['failed'] += num_failed
                 continue
-            for test in td['tests']:
-                passed = False
-                try:
-                    result = r.do(test['data'], schema_filter).run(conn)
-                    passed = result is test['valid']
-                except r.ReqlError as re:
-                    passed = test['valid'] is False
+            outcomes = run_tests(conn, schema_filter, td['tests'])
+            for test, passed in zip(td['tests'], outcomes):
                 click.echo('  ' + test['description'] + ': ', nl=False)
                 if passed:
                     click.secho('passed', fg='green')
@@ -54,16 +49,37 @@ def main(match, print_success):
                     if print_success:
                         click.echo('    Data: ' + json.dumps(test['data']))
                         click.echo('    Schema: ' + json.dumps(td['schema']))
-                        click.echo('    ReQL: ' + str(r.expr(schema_filter)))
+                        click.echo('    ReQL: ' + str(schema_filter))
                 else:
                     click.secho('failed', fg='red', bold=True)
                     results[name]['failed'] += 1
                     click.echo('    Data: ' + json.dumps(test['data']))
                     click.echo('    Schema: ' + json.dumps(td['schema']))
-                    click.echo('    ReQL: ' + str(r.expr(schema_filter)))
+                    click.echo('    ReQL: ' + str(schema_filter))
     summary(results)
 
 
+def run_tests(conn, schema_filter, tests):
+    '''Runs a schema filter against all the tests' data in one query
+
+    Returns whether each test passed. A query error for one piece of
+    data counts as it being invalid. If the batched query fails as a
+    whole, each test is run on its own instead.
+    '''
+    try:
+        results = r.expr([test['data'] for test in tests]).map(
+            lambda data: r.do(data, schema_filter).default(False)
+        ).run(conn)
+    except r.ReqlError:
+        results = []
+        for test in tests:
+            try:
+                results.append(r.do(test['data'], schema_filter).run(conn))
+            except r.ReqlError:
+                results.append(False)
+    return [result is test['valid'] for result, test in zip(results, tests)]
+
+
 def summary(results):
     total_overall = 0
     total_passed = 0